@@ -1,17 +1,21 @@
 #!/usr/local/bin/python3.9
 
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.config import Config
 import botocore.exceptions 
 
 import json
 import os
+import hashlib
 import itertools
 import argparse
 import subprocess
 from lxml import etree
 
 import asyncio, aiohttp
+import random
+import concurrent.futures
 
 from typing import List, Tuple, Any, Optional, Dict
 
@@ -65,11 +69,23 @@ TODO
 #   for use with all the download functions except download_metadata
 # `load_raw_page`, below, loads an un-processed page document (also from disk)
 #   for use with download_metadata
+#
+# download_metadata in resync mode additionally writes `<category>.changed.json` next to
+# the metadata file, mapping article IDs of already-stored articles to the list of
+# components (html, img, video) which changed since they were stored. `load` reads it
+# into `changed` if present, and the downloaders re-fetch those components even if
+# the files already exist on disk.
+#
+# store_articles in skip-unchanged mode records a fingerprint of each metadata object it
+# has stored (or found to be already stored) in `<category>.stored.json`, which `load`
+# reads into `stored`, so that re-running it over the same metadata makes no requests.
 class article_metadata():
     def __init__(self, json_dir, subdir, category):
         self.json_dir=os.path.join(json_dir, subdir)
         self.category=category
         self.data={}
+        self.changed={}
+        self.stored={}
 
     def load(self, cond=None):
         if cond is None:
@@ -86,17 +102,81 @@ class article_metadata():
         except Exception as e:
             raise
 
+        try:
+            with open(self.changed_path(), 'r') as f:
+                changed=json.load(f)
+                self.changed.update({ k: v for (k, v) in changed.items() if k in self.data })
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(self.stored_path(), 'r') as f:
+                self.stored.update(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    def changed_path(self):
+        return os.path.join(self.json_dir, self.category, self.category+'.changed.json')
+
+    def save_changed(self):
+        with open(self.changed_path(), 'w') as f:
+            json.dump(self.changed, f, indent=4)
+
+    def stored_path(self):
+        return os.path.join(self.json_dir, self.category, self.category+'.stored.json')
+
+    def save_stored(self):
+        with open(self.stored_path(), 'w') as f:
+            json.dump(self.stored, f, indent=4)
+
+    # fingerprint of a metadata object as downloaded, before any conversion by store_articles
+    @staticmethod
+    def fingerprint(item):
+        return hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    # compare the metadata stored for an article with newly downloaded metadata for the
+    # same article, and return the list of components which need to be downloaded again
+    #   update_time => article HTML (and the text extracted from it)
+    #   img_update_time => article image, and the article HTML since the image URL is
+    #       taken from the HTML
+    #   movie (URL) => article video
+    @staticmethod
+    def changed_components(stored, item):
+        def differs(k):
+            return str(stored.get(k, '')) != str(item.get(k, ''))
+
+        ret=[]
+        if differs('update_time') or differs('img_update_time'):
+            ret.append('html')
+        if differs('img_update_time'):
+            ret.append('img')
+        if differs('movie') and item.get('movie', '') != '':
+            ret.append('video')
+
+        return ret
+
+    def is_changed(self, article_id, component):
+        return component in self.changed.get(article_id, [])
+
     # try to load one page of metadata
     @staticmethod
     def load_raw_page(path, item_key='item'):
         with open(path, 'r') as f:
             data=json.load(f)
             if data['article_count'] == 0 or not item_key in data:
-                self.log(f'article_metadata.load_raw_page: no articles found, returning None ({path})')
+                print(f'article_metadata.load_raw_page: no articles found, returning None ({path})')
                 return None
 
             return data
 
+    # write a list of article metadata objects as the processed document read by `load`
+    def save(self, items):
+        os.makedirs(os.path.join(self.json_dir, self.category), exist_ok=True)
+        with open(os.path.join(self.json_dir, self.category, self.category+'.json'), 'w') as f:
+            json.dump(items, f, indent=4, ensure_ascii=False)
+
+        self.data.update({ v['article_no']: v for v in items })
+
     def read(self):
         for x in self.data.values():
             yield x
@@ -125,6 +205,8 @@ class Asahi():
         aws_profile=None,
         curl_proxy=None,
         quiet=False,
+        parse_workers=None,
+        parse_chunk_size=16,
     ):
 
         self.url_templates = url_templates
@@ -133,6 +215,12 @@ class Asahi():
         self.quiet = quiet
         self.aws_profile=aws_profile
 
+        # article HTML is parsed in a process pool of parse_workers processes (default:
+        # number of CPUs), in batches of parse_chunk_size articles (see _parse_articles_html)
+        self.parse_workers=parse_workers
+        self.parse_chunk_size=parse_chunk_size
+        self.parse_pool=None
+
         if aws_profile:
             self.aws_session = aws_session(aws_profile)
 
@@ -144,6 +232,12 @@ class Asahi():
         if not self.quiet:
             print(msg)
 
+    # shut down the process pool used for parsing, if it was started
+    def close(self):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool=None
+
 
 
     async def create_tables(self, delete_existing):
@@ -219,6 +313,10 @@ class Asahi():
         x=subprocess.run(args)
 
 
+    def _metadata_url(self, category, page):
+        page_str='%04d' % page
+        return (self.url_templates['metadata'] % (self.categories[category], page_str))
+
     def _html_path(self, category, article_id):
         return os.path.join(self.html_dir, category, article_id+'.html')
 
@@ -231,8 +329,12 @@ class Asahi():
     (if applicable)
 
     url_f provides the URL, given the article_metadata object and the article ID
+
+    component is the name of the data component (html, img, video) being downloaded;
+    existing files are downloaded again if the article_metadata object marks that
+    component as changed for the article (see download_metadata with resync=True)
     """
-    async def _generic_downloader(self, md : article_metadata, dst_dir, url_f, sleep_time=5):
+    async def _generic_downloader(self, md : article_metadata, dst_dir, url_f, sleep_time=5, component=None):
         nonempty=None
         failed=[]
 
@@ -254,8 +356,11 @@ class Asahi():
             dst_path=os.path.join(dst_dir, os.path.basename(url))
             try:
                 os.stat(dst_path)
-                print(f'skipping: already exists: {dst_path}')
-                continue
+                if md.is_changed(article_id, component):
+                    print(f'{article_id}: {component} changed, downloading again: {dst_path}')
+                else:
+                    print(f'skipping: already exists: {dst_path}')
+                    continue
             except FileNotFoundError:
                 pass
 
@@ -281,7 +386,15 @@ class Asahi():
 
 
 
-    async def download_metadata(self, category, sleep_time=5, item_key='item', metadata_subdir=None):
+    """
+    resync: instead of stopping at the first article which is already stored, also
+    include stored articles whose metadata timestamps differ from those stored in the DB,
+    recording the changed components in the `.changed.json` file (see article_metadata).
+    Downloading stops after the first page in which every article is stored and unchanged.
+    Since articles are ordered by update_time only, an article whose image was replaced
+    without changing its update_time is not found if it is beyond that page.
+    """
+    async def download_metadata(self, category, sleep_time=5, item_key='item', metadata_subdir=None, resync=False):
         if category not in self.categories:
             raise ValueError(f'unknown category {category}')
 
@@ -302,12 +415,8 @@ class Asahi():
         def path(page):
             return os.path.join(json_dir, ('page%04d' % page) + '.json')
 
-        def url(page):
-            page_str='%04d' % page
-            return (self.url_templates['metadata'] % (self.categories[category], page_str))
-
         def do_dl(page):
-            a=url(page)
+            a=self._metadata_url(category, page)
             b=path(page)
             self.log(f'download_metadata: downloading {a} -> {b}')
             self._dl(a, to_file=b)
@@ -320,6 +429,27 @@ class Asahi():
                 loaded_page[item_key],
             ))
 
+        changed={}
+
+        def prune_unchanged(loaded_page):
+            pending=[]
+            for item in loaded_page[item_key]:
+                article_id=item['article_no']
+                stored=self.fetch_metadata(article_id)
+                if stored is None:
+                    pending.append(item)
+                    continue
+
+                components=article_metadata.changed_components(stored, item)
+                if len(components) > 0:
+                    self.log(f'download_metadata: {article_id} changed ({components})')
+                    changed[article_id]=components
+                    pending.append(item)
+
+            return pending
+
+        prune=prune_unchanged if resync else prune_existing
+
         concatenated=[]
 
         # check content of first page of metadata to get total number of pages
@@ -330,7 +460,7 @@ class Asahi():
         except KeyError:
             raise Exception(f'malformed first page at {path(1)}: max_page key not present')
 
-        pruned=prune_existing(current_page)
+        pruned=prune(current_page)
         concatenated=pruned
 
         self.log(f'will download at most {max_page} total pages')
@@ -341,7 +471,12 @@ class Asahi():
             # while iterating in the loop), we break, since we assume that we have
             # the articles in all subsequent pages
             # but check the exact difference anyway to report to the user
-            if len(pruned) != len(current_page[item_key]):
+            # in resync mode, we only stop once a page contains no new or changed articles
+            if resync:
+                if len(pruned) == 0:
+                    self.log(f'no new or changed articles in page {i - 1}, not downloading any further pages.')
+                    break
+            elif len(pruned) != len(current_page[item_key]):
                 (a, b)=(
                     set([ v['article_no'] for v in x ])
                     for x in (pruned, current_page[item_key])
@@ -355,7 +490,7 @@ class Asahi():
             path_i=path(i)
             current_page=article_metadata.load_raw_page(path_i)
 
-            pruned=prune_existing(current_page)
+            pruned=prune(current_page)
             concatenated.extend(pruned)
 
             await asyncio.sleep(sleep_time)
@@ -369,6 +504,97 @@ class Asahi():
             json.dump(concatenated, f, indent=4, ensure_ascii=False)
             self.log(f'wrote full metadata file to {out_path} (subdir is {subdir})')
 
+        if len(changed) > 0:
+            changed_path=os.path.join(json_dir, f'{category}.changed.json')
+            with open(changed_path, 'w') as f:
+                json.dump(changed, f, indent=4)
+                self.log(f'wrote list of {len(changed)} changed articles to {changed_path}')
+
+
+
+    """
+    Long-running alternative to running download-metadata and the other commands
+    periodically: poll the first metadata page of each category every `interval`
+    (+/- `jitter`) seconds, and download and store only articles not seen before.
+
+    The metadata of stored articles on the first page is kept in memory, so the DB is
+    only consulted for articles which were not on the first page in the previous poll.
+    Articles whose metadata differs from that stored are handled as in download_metadata
+    with resync=True. New and changed articles are saved to a fresh metadata subdir, as
+    with download_metadata, before the other components are downloaded.
+    """
+    async def watch(self, categories, interval=60, jitter=10, sleep_time=5, item_key='item'):
+        for category in categories:
+            if category not in self.categories:
+                raise ValueError(f'unknown category {category}')
+
+        # category => { article ID => metadata as stored }
+        known={ category: {} for category in categories }
+
+        while True:
+            for category in categories:
+                try:
+                    await self._watch_poll(category, known, sleep_time, item_key)
+                except Exception as e:
+                    print(f'watch: poll failed for {category}: {e}')
+
+            delay=max(0, interval + random.uniform(-jitter, jitter))
+            self.log(f'watch: next poll in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    async def _watch_poll(self, category, known, sleep_time, item_key):
+        page_dir=os.path.join(self.json_dir, category+'_watch', category)
+        os.makedirs(page_dir, exist_ok=True)
+
+        path=os.path.join(page_dir, 'page0001.json')
+        self._dl(self._metadata_url(category, 1), to_file=path)
+        page=article_metadata.load_raw_page(path, item_key)
+        if page is None:
+            return
+
+        items=page[item_key]
+        new=[]
+        changed={}
+        for item in items:
+            article_id=item['article_no']
+            stored=known[category].get(article_id)
+            if stored is None:
+                stored=self.fetch_metadata(article_id)
+
+            if stored is not None:
+                components=article_metadata.changed_components(stored, item)
+                if len(components) == 0:
+                    known[category][article_id]=stored
+                    continue
+
+                changed[article_id]=components
+
+            new.append(item)
+
+        # only the first page is ever compared, so articles no longer on it can be forgotten
+        ids=set([ item['article_no'] for item in items ])
+        known[category]={ k: v for (k, v) in known[category].items() if k in ids }
+
+        if len(new) == 0:
+            return
+
+        self.log(f'watch: {len(new) - len(changed)} new and {len(changed)} changed articles in {category}')
+
+        subdir=category+'_'+datetime.now().isoformat()
+        md=article_metadata(self.json_dir, subdir, category)
+        md.save(new)
+        if len(changed) > 0:
+            md.changed.update(changed)
+            md.save_changed()
+
+        await self.download_articles_html(md, sleep_time)
+        await self.download_images(md, sleep_time)
+        await self.download_videos(md, sleep_time)
+        written=await self.store_articles(md)
+
+        # only mark articles as known once they have been stored, so that those which
+        # failed at any step are retried in the next poll
+        known[category].update({ article_id: md.find(article_id) for article_id in written })
 
 
     """
@@ -377,9 +603,12 @@ class Asahi():
     """
     async def download_images(self, md : article_metadata, sleep_time=5):
 
+        parsed={}
+        async for (article_id, data) in self._parse_articles_html(md, [ x['article_no'] for x in md.read() ]):
+            parsed[article_id]=data
+
         def f(md, article_id):
-            html_path=self._html_path(md.category, article_id)
-            data=self.parse_article_html(html_path)
+            data=parsed[article_id]
 
             if data is None:
                 print('download_images: parse_article_html returned None, skipping')
@@ -389,7 +618,7 @@ class Asahi():
             return url
 
         img_dir=os.path.join(self.img_dir, md.category)
-        await self._generic_downloader(md, img_dir, f, sleep_time=sleep_time)
+        await self._generic_downloader(md, img_dir, f, sleep_time=sleep_time, component='img')
         
 
 
@@ -399,7 +628,7 @@ class Asahi():
                 return url
 
         html_dir=os.path.join(self.html_dir, md.category)
-        await self._generic_downloader(md, html_dir, f, sleep_time=sleep_time)
+        await self._generic_downloader(md, html_dir, f, sleep_time=sleep_time, component='html')
 
 
 
@@ -414,7 +643,7 @@ class Asahi():
             return url
 
         video_dir=os.path.join(self.video_dir, md.category)
-        await self._generic_downloader(md, video_dir, f, sleep_time=sleep_time)
+        await self._generic_downloader(md, video_dir, f, sleep_time=sleep_time, component='video')
 
 
     @staticmethod
@@ -457,43 +686,198 @@ class Asahi():
         return None
 
     
+    """
+        Parse the saved HTML of the given articles, yielding (article_id, data) tuples
+        (data being the return value of parse_article_html) as they become available.
+
+        Parsing is CPU-bound, so the articles are split into chunks of parse_chunk_size
+        which are parsed in a process pool, in no particular order. A single chunk is
+        parsed inline, since there is nothing to gain from starting the pool.
+
+        The pool is started on first use and kept for later calls (see close). If the
+        caller stops iterating early, the remaining chunks are cancelled and the pool is
+        shut down without waiting for them, and a new one is started on the next call.
+    """
+    async def _parse_articles_html(self, md : article_metadata, article_ids):
+        paths=[ (article_id, self._html_path(md.category, article_id)) for article_id in article_ids ]
+        n=self.parse_chunk_size
+        chunks=[ paths[i:i+n] for i in range(0, len(paths), n) ]
+
+        if len(chunks) <= 1 or self.parse_workers == 1:
+            for chunk in chunks:
+                for x in _parse_article_html_chunk(chunk):
+                    yield x
+            return
+
+        if self.parse_pool is None:
+            self.parse_pool=concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_workers)
+        pool=self.parse_pool
+
+        loop=asyncio.get_running_loop()
+        pending=[ loop.run_in_executor(pool, _parse_article_html_chunk, chunk) for chunk in chunks ]
+        done=False
+        try:
+            for f in asyncio.as_completed(pending):
+                for x in await f:
+                    yield x
+
+            done=True
+        finally:
+            if not done:
+                for f in pending:
+                    f.cancel()
+
+                pool.shutdown(wait=False, cancel_futures=True)
+                if self.parse_pool is pool:
+                    self.parse_pool=None
+
+    
     """
         Iterate over article metadata JSON previously saved by the download-metadata
         command, additionally reading the article contents (HTML) saved by the 
         download-articles command.
         (1) Read in article's HTML file and extract the article contents
         (2) Insert the metadata and article contents as JSON
+
+        skip_unchanged: skip articles whose fingerprint was recorded by a previous run
+        (see article_metadata), and only write an article if its update_time (or, for the
+        same update_time, img_update_time) is newer than that of the stored metadata,
+        or if only its video URL changed. The stored metadata is read first, since the
+        content is written before it.
+
+        Returns the IDs of the articles which were written.
     """
-    async def store_articles(self, md : article_metadata):
+    async def store_articles(self, md : article_metadata, skip_unchanged=False):
         metadata_tbl=self.aws_session.db_rsrc.Table(self.aws_session.metadata_tbl_name)
         article_tbl=self.aws_session.db_rsrc.Table(self.aws_session.article_tbl_name)
 
-        for metadata_item in md.read():
-            print('processing %s' % metadata_item['article_no'])
+        # unchanged: already stored with the same timestamps
+        # condition_failed: a newer version of the article is already stored
+        counts={ k: 0 for k in ['written', 'unchanged', 'condition_failed', 'failed'] }
+        written=[]
 
-            # convert these entries from str to int
-            for k in ['update_time','category_id']:
-                metadata_item[k]=int(metadata_item[k])
+        article_ids=[ x['article_no'] for x in md.read() ]
+        if skip_unchanged:
+            fingerprints={ x: article_metadata.fingerprint(md.find(x)) for x in article_ids }
+            pending=[ x for x in article_ids if md.stored.get(x) != fingerprints[x] ]
+            counts['unchanged']+=len(article_ids) - len(pending)
+            article_ids=pending
 
-            article_id=metadata_item['article_no']
-            try:
-                data=self.parse_article_html(self._html_path(md.category, article_id))
-            except OSError:
-                print('failed reading HTML for ID %s' % metadata_item['article_no'])
-                continue
+        try:
+            async for (article_id, data) in self._parse_articles_html(md, article_ids):
+                metadata_item=md.find(article_id)
+                print('processing %s' % article_id)
+
+                # convert these entries from str to int
+                for k in ['update_time','category_id']:
+                    metadata_item[k]=int(metadata_item[k])
+
+                if data is None:
+                    print(f'store_articles: parse_article_html returned None for {article_id}, skipping')
+                    counts['failed']+=1
+                    continue
+
+                # the metadata is written last, so that an article whose metadata is stored
+                # also has its content stored
+                if skip_unchanged:
+                    result=self._metadata_status(self.fetch_metadata(article_id), metadata_item)
+                    if result != 'written':
+                        print(f'store_articles: not writing {article_id} ({result})')
+                        counts[result]+=1
+                        md.stored[article_id]=fingerprints[article_id]
+                        continue
+
+                data['article_no']=article_id
+                article_tbl.put_item(
+                    Item=data
+                )
 
-            if data is None:
-                print(f'store_articles: parse_article_html returned None for {article_id}, skipping')
-                continue
+                if skip_unchanged:
+                    result=self._put_metadata_if_newer(metadata_tbl, metadata_item)
+                    if result != 'written':
+                        print(f'store_articles: metadata for {article_id} changed while writing ({result})')
+                        counts[result]+=1
+                        continue
+
+                    md.stored[article_id]=fingerprints[article_id]
+                else:
+                    metadata_tbl.put_item(
+                        Item=metadata_item,
+                    )
 
+                counts['written']+=1
+                written.append(article_id)
+
+        finally:
+            if skip_unchanged:
+                md.save_stored()
+
+        print('store_articles: ' + ', '.join([ f'{k}={v}' for (k, v) in counts.items() ]))
+        return written
+
+    # compare the stored metadata item for an article (or None) with an incoming one
+    # (after conversion by store_articles), returning which of the counts in store_articles
+    # writing the incoming item belongs to
+    @staticmethod
+    def _metadata_status(stored, metadata_item):
+        if stored is None:
+            return 'written'
+
+        a=(int(stored['update_time']), stored['img_update_time'])
+        b=(metadata_item['update_time'], metadata_item['img_update_time'])
+        if a == b:
+            # a changed video has no timestamp of its own (see article_metadata.changed_components)
+            if 'video' in article_metadata.changed_components(stored, metadata_item):
+                return 'written'
+
+            return 'unchanged'
+
+        return 'written' if a < b else 'condition_failed'
+
+    # conditionally write a metadata item, with the same outcomes as _metadata_status;
+    # the condition guards against the item being changed since it was read
+    def _put_metadata_if_newer(self, metadata_tbl, metadata_item):
+        try:
             metadata_tbl.put_item(
                 Item=metadata_item,
+                ConditionExpression='attribute_not_exists(article_no) OR update_time < :t'
+                    ' OR (update_time = :t AND img_update_time < :it)'
+                    ' OR (update_time = :t AND img_update_time = :it'
+                    ' AND (attribute_not_exists(movie) OR movie <> :m))',
+                ExpressionAttributeValues={
+                    ':t': metadata_item['update_time'],
+                    ':it': metadata_item['img_update_time'],
+                    ':m': metadata_item['movie'],
+                },
+                ReturnValuesOnConditionCheckFailure='ALL_OLD',
             )
+            return 'written'
 
-            data['article_no']=article_id
-            article_tbl.put_item(
-                Item=data
-            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+            # older botocore versions don't support ReturnValuesOnConditionCheckFailure
+            if 'Item' in e.response:
+                stored={ k: TypeDeserializer().deserialize(v) for (k, v) in e.response['Item'].items() }
+            else:
+                stored=self.fetch_metadata(metadata_item['article_no'])
+
+            if stored is None:
+                return 'condition_failed'
+
+            return self._metadata_status(stored, metadata_item)
+
+    # fetch only the stored metadata for an article, or None if it is not stored
+    def fetch_metadata(self, article_no):
+        metadata_tbl=self.aws_session.db_rsrc.Table(self.aws_session.metadata_tbl_name)
+        resp=metadata_tbl.get_item(
+            Key={
+                'article_no': article_no
+            },
+        )
+
+        return resp['Item'] if 'Item' in resp else None
 
     # TODO  incorporate sorting to get most recent article
     def fetch_article(self, article_no):
@@ -536,3 +920,21 @@ class Asahi():
             #else:
             #    raise e
 
+
+# run in the worker processes of Asahi._parse_articles_html
+def _parse_article_html_chunk(paths):
+    ret=[]
+    for (article_id, path) in paths:
+        try:
+            data=Asahi.parse_article_html(path)
+        except OSError:
+            print(f'failed reading HTML for ID {article_id}')
+            data=None
+        except Exception as e:
+            # eg KeyError for unexpected JSON+LD content; reported as failed by the callers
+            print(f'failed parsing HTML for ID {article_id}: {repr(e)}')
+            data=None
+
+        ret.append((article_id, data))
+
+    return ret
@@ -22,7 +22,8 @@ handler_keys=[
     'download-articles',
     'store-articles',
     'delete-create-tables',
-    'fetch-article'
+    'fetch-article',
+    'watch',
 ]
 
 handlers = { k: None for k in handler_keys }
@@ -36,11 +37,14 @@ async def main():
     )
 
     prs.add_argument('--config', required=True)
-    prs.add_argument('--sleep-time')
+    prs.add_argument('--sleep-time', type=float)
     prs.add_argument('--aws-profile')
     prs.add_argument('--quiet', action=argparse.BooleanOptionalAction)
 
-    prs.set_defaults(quiet=False, sleep_time=5)
+    prs.add_argument('--parse-workers', type=int)
+    prs.add_argument('--parse-chunk-size', type=int)
+
+    prs.set_defaults(quiet=False, sleep_time=5, parse_chunk_size=16)
 
     
     subprs=prs.add_subparsers(required=True)
@@ -50,18 +54,32 @@ async def main():
         sp = subprs.add_parser(cmd)
         sp.set_defaults(cmd=cmd)
 
-        if cmd not in ['delete-create-tables', 'fetch-article']:
+        if cmd not in ['delete-create-tables', 'fetch-article', 'watch']:
             sp.add_argument('--category', required=True)
 
+        # watch all configured categories unless given one or more explicitly
+        if cmd == 'watch':
+            sp.add_argument('--category', action='append')
+            sp.add_argument('--interval', type=float, default=60)
+            sp.add_argument('--jitter', type=float, default=10)
+
         if cmd == 'fetch-article':
             sp.add_argument('--article-id', required=True)
 
-        if cmd not in ['download-metadata', 'delete-create-tables', 'fetch-article']:
+        if cmd not in ['download-metadata', 'delete-create-tables', 'fetch-article', 'watch']:
             sp.add_argument('--metadata-subdir', required=True)
 
         # allow user to specify their own metadata subdir (eg for scripting)
         if cmd == 'download-metadata':
             sp.add_argument('--metadata-subdir', required=False)
+            # also pick up changes to already-stored articles (see Asahi.download_metadata)
+            sp.add_argument('--resync', action=argparse.BooleanOptionalAction)
+            sp.set_defaults(resync=False)
+
+        # only write articles which are newer than those already stored (see Asahi.store_articles)
+        if cmd == 'store-articles':
+            sp.add_argument('--skip-unchanged', action=argparse.BooleanOptionalAction)
+            sp.set_defaults(skip_unchanged=False)
 
         subprs_inst[cmd]=sp
 
@@ -84,15 +102,17 @@ async def main():
         curl_proxy=config['curl_proxy'] if 'curl_proxy' in config else None
         aws_profile=config['aws_profile']
 
-    obj=asahi.Asahi(categories, local_paths, url_templates, aws_profile, curl_proxy, quiet)
+    obj=asahi.Asahi(categories, local_paths, url_templates, aws_profile, curl_proxy, quiet,
+        args['parse_workers'], args['parse_chunk_size'])
 
     # our processing uses existing (previously downloaded) on-disk metadata except for these commands
-    if cmd not in [ 'download-metadata', 'delete-create-tables', 'fetch-article' ]:
+    if cmd not in [ 'download-metadata', 'delete-create-tables', 'fetch-article', 'watch' ]:
         md=asahi.article_metadata(local_paths['json'], args['metadata_subdir'], args['category'])
         md.load()
 
     async def download_metadata(): 
-        await obj.download_metadata(args['category'], sleep_time, metadata_subdir=args['metadata_subdir'])
+        await obj.download_metadata(args['category'], sleep_time, metadata_subdir=args['metadata_subdir'],
+            resync=args['resync'])
 
     async def download_articles(): 
         await obj.download_articles_html(md, sleep_time)
@@ -104,11 +124,15 @@ async def main():
         await obj.download_videos(md, sleep_time)
 
     async def store_articles(): 
-        await obj.store_articles(md)
+        await obj.store_articles(md, args['skip_unchanged'])
 
     async def create_tables(): 
         await obj.create_tables(True)
 
+    async def watch(): 
+        watch_categories=args['category'] if args['category'] else list(categories.keys())
+        await obj.watch(watch_categories, args['interval'], args['jitter'], sleep_time)
+
     async def fetch_article(): 
         class J(json.JSONEncoder):
             def default(self, x):
@@ -133,8 +157,12 @@ async def main():
     handlers['store-articles'] = store_articles
     handlers['delete-create-tables'] = create_tables
     handlers['fetch-article'] = fetch_article
+    handlers['watch'] = watch
 
-    await handlers[cmd]()
+    try:
+        await handlers[cmd]()
+    finally:
+        obj.close()
 
 
 if __name__ == '__main__':
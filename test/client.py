@@ -7,6 +7,10 @@ import argparse
 import subprocess
 
 import asyncio
+import tempfile
+import shutil
+
+import botocore.exceptions
 
 from typing import List, Tuple, Any, Optional, Dict
 
@@ -56,7 +60,361 @@ def test_load_metadata():
                 raise AssertionError(f'failed for {k}')
 
 
-test_extract_article()
+def test_changed_components():
+    stored={
+        'article_no': '000325411',
+        'update_time': 20231123180045,
+        'img_update_time': '20231123193906',
+        'movie': 'https://example.com/000325411.mp4',
+    }
+
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, update_time='20231123180045')) == [])
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, update_time='20231124000000')) == ['html'])
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, img_update_time='20231124000000')) == ['html', 'img'])
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, update_time='20231124000000', img_update_time='20231124000000')) == ['html', 'img'])
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, movie='https://example.com/000325411_2.mp4')) == ['video'])
+    assert(asahi.article_metadata.changed_components(stored, 
+        dict(stored, movie='')) == [])
+
+    # changes recorded by download_metadata are picked up by load
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, 'subdir', 'c'))
+        with open(os.path.join(d, 'subdir', 'c', 'c.json'), 'w') as f:
+            json.dump([ stored ], f)
+
+        md=asahi.article_metadata(d, 'subdir', 'c')
+        with open(md.changed_path(), 'w') as f:
+            json.dump({ '000325411': ['img'], '000000000': ['html'] }, f)
+
+        md.load()
+        assert(md.is_changed('000325411', 'img'))
+        assert(not md.is_changed('000325411', 'html'))
+        assert(not md.is_changed('000000000', 'html'))
+
+
+def test_save_metadata():
+    md=asahi.article_metadata('./data/json', 'subdir', 'test_category')
+    md.load()
+    items=list(md.read())[:3]
+
+    with tempfile.TemporaryDirectory() as d:
+        saved=asahi.article_metadata(d, 'subdir', 'test_category')
+        saved.save(items)
+
+        loaded=asahi.article_metadata(d, 'subdir', 'test_category')
+        loaded.load()
+        assert(list(loaded.read()) == items)
+        assert(loaded.changed == {})
+
+
+def test_parse_articles_html():
+    article_ids=['000278054', '000278054', '000000000']
+
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, 'html', 'c'))
+        shutil.copy('./data/000278054.html', os.path.join(d, 'html', 'c'))
+        md=asahi.article_metadata(d, 'subdir', 'c')
+
+        # NewsArticle JSON+LD without an image
+        with open('./data/000278054.html', 'r', encoding='utf-8') as f:
+            html=f.read().replace('"image"', '"no-image"')
+        with open(os.path.join(d, 'html', 'c', '000000001.html'), 'w', encoding='utf-8') as f:
+            f.write(html)
+
+        assert(asahi._parse_article_html_chunk([('000000001', os.path.join(d, 'html', 'c', '000000001.html'))])
+            == [('000000001', None)])
+
+        for (workers, chunk_size) in [(1, 16), (2, 1)]:
+            obj=asahi.Asahi({}, { 'html': os.path.join(d, 'html') }, {}, parse_workers=workers, parse_chunk_size=chunk_size)
+
+            async def collect():
+                return [ x async for x in obj._parse_articles_html(md, article_ids) ]
+
+            ret=asyncio.run(collect())
+            assert(sorted([ x[0] for x in ret ]) == sorted(article_ids))
+            for (article_id, data) in ret:
+                assert((data is None) == (article_id == '000000000'))
+
+            # the pool is kept between calls, unless iteration stops early
+            pool=obj.parse_pool
+            assert(len(asyncio.run(collect())) == len(article_ids))
+            assert(obj.parse_pool is pool)
+
+            async def first():
+                gen=obj._parse_articles_html(md, article_ids)
+                async for x in gen:
+                    break
+                await gen.aclose()
+
+            asyncio.run(first())
+            if workers > 1:
+                assert(obj.parse_pool is None)
+
+            obj.close()
+
+
+# in-memory stand-ins for the DynamoDB tables and aws_session used by Asahi
+class fake_table():
+    def __init__(self):
+        self.items={}
+        self.reads=[]
+        self.fail=False
+        # whether failed condition checks return the stored item (ReturnValuesOnConditionCheckFailure)
+        self.return_old=True
+
+    def get_item(self, Key):
+        self.reads.append(Key['article_no'])
+        if Key['article_no'] in self.items:
+            return { 'Item': dict(self.items[Key['article_no']]) }
+        return {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        if self.fail:
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'InternalServerError' } }, 'PutItem')
+
+        stored=self.items.get(Item['article_no'])
+        v=ExpressionAttributeValues
+        if ConditionExpression is not None and stored is not None \
+            and (stored['update_time'], stored['img_update_time']) >= (v[':t'], v[':it']) \
+            and ((stored['update_time'], stored['img_update_time']) != (v[':t'], v[':it'])
+                or stored['movie'] == v[':m']):
+            resp={ 'Error': { 'Code': 'ConditionalCheckFailedException' } }
+            if self.return_old:
+                resp['Item']={
+                    'update_time': { 'N': str(stored['update_time']) },
+                    'img_update_time': { 'S': stored['img_update_time'] },
+                    'movie': { 'S': stored['movie'] },
+                }
+            raise botocore.exceptions.ClientError(resp, 'PutItem')
+
+        self.items[Item['article_no']]=dict(Item)
+
+
+def fake_session(tables):
+    class session():
+        metadata_tbl_name='asahi-metadata'
+        article_tbl_name='asahi-content'
+
+        class db_rsrc():
+            @staticmethod
+            def Table(name):
+                return tables[name]
+
+    return session()
+
+
+def test_store_articles_skip_unchanged():
+    tables={ 'asahi-metadata': fake_table(), 'asahi-content': fake_table() }
+
+    item={
+        'article_no': '000278054',
+        'update_time': '20231123180045',
+        'img_update_time': '20231123193906',
+        'category_id': '11',
+        'movie': 'https://example.com/000278054.mp4',
+    }
+
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, 'html', 'c'))
+        shutil.copy('./data/000278054.html', os.path.join(d, 'html', 'c'))
+
+        obj=asahi.Asahi({}, { 'json': d, 'html': os.path.join(d, 'html') }, {})
+        obj.aws_session=fake_session(tables)
+
+        def store(item):
+            md=asahi.article_metadata(d, 'subdir', 'c')
+            md.save([ item ])
+            md.load()
+            return asyncio.run(obj.store_articles(md, skip_unchanged=True))
+
+        # a failed content write leaves neither the metadata nor the fingerprint behind
+        tables['asahi-content'].fail=True
+        try:
+            store(dict(item))
+            raise AssertionError('expected content write to fail')
+        except botocore.exceptions.ClientError:
+            pass
+
+        tables['asahi-content'].fail=False
+        assert(len(tables['asahi-metadata'].items) == 0)
+
+        assert(store(dict(item)) == ['000278054'])
+        assert(tables['asahi-metadata'].items['000278054']['update_time'] == 20231123180045)
+        assert(len(tables['asahi-content'].items) == 1)
+
+        # second run is skipped using the fingerprint, without touching the tables
+        tables['asahi-content'].items.clear()
+        assert(store(dict(item)) == [])
+        assert(len(tables['asahi-content'].items) == 0)
+
+        # an older version is rejected by the condition
+        os.remove(os.path.join(d, 'subdir', 'c', 'c.stored.json'))
+        store(dict(item, update_time='20231101000000'))
+        assert(tables['asahi-metadata'].items['000278054']['update_time'] == 20231123180045)
+        assert(len(tables['asahi-content'].items) == 0)
+
+        store(dict(item, update_time='20231201000000'))
+        assert(tables['asahi-metadata'].items['000278054']['update_time'] == 20231201000000)
+        assert(len(tables['asahi-content'].items) == 1)
+
+        # a changed video URL is written although the timestamps are the same
+        tables['asahi-content'].items.clear()
+        movie='https://example.com/000278054_2.mp4'
+        assert(store(dict(item, update_time='20231201000000', movie=movie)) == ['000278054'])
+        assert(tables['asahi-metadata'].items['000278054']['movie'] == movie)
+
+        # without the stored item in the error response, it is read again
+        tables['asahi-metadata'].return_old=False
+        stored=tables['asahi-metadata'].items['000278054']
+        assert(obj._put_metadata_if_newer(tables['asahi-metadata'], dict(stored)) == 'unchanged')
+        assert(obj._put_metadata_if_newer(tables['asahi-metadata'],
+            dict(stored, update_time=20231101000000)) == 'condition_failed')
+
+
+def test_watch_poll():
+    tables={ 'asahi-metadata': fake_table(), 'asahi-content': fake_table() }
+
+    def item(article_id, update_time='100'):
+        return {
+            'article_no': article_id,
+            'update_time': update_time,
+            'img_update_time': '100',
+            'category_id': '1',
+            'movie': '',
+        }
+
+    with tempfile.TemporaryDirectory() as d:
+        local_paths={ k: os.path.join(d, k) for k in ['json', 'html', 'img', 'video'] }
+        for x in local_paths.values():
+            os.makedirs(x)
+
+        url_templates={ 'metadata': 'metadata/%d/%s', 'html': 'html/%s/%s.html' }
+        obj=asahi.Asahi({ 'c': 1 }, local_paths, url_templates)
+        obj.aws_session=fake_session(tables)
+
+        page=[]
+        fail_html=set()
+        downloaded=[]
+
+        # stands in for curl: serve `page` as metadata page 1, and the test article as HTML
+        def dl(url, to_file=None):
+            if url.startswith('metadata/'):
+                with open(to_file, 'w') as f:
+                    json.dump({ 'article_count': len(page), 'max_page': 1, 'item': page }, f)
+            elif url.startswith('html/'):
+                article_id=os.path.basename(url)[:-len('.html')]
+                if article_id not in fail_html:
+                    downloaded.append(article_id)
+                    shutil.copy('./data/000278054.html', to_file)
+            else:
+                open(to_file, 'w').close()
+
+        obj._dl=dl
+        known={ 'c': {} }
+
+        def poll(items):
+            page[:]=items
+            tables['asahi-metadata'].reads.clear()
+            downloaded.clear()
+            asyncio.run(obj._watch_poll('c', known, 0, 'item'))
+
+        # first poll: `a` is already stored, the HTML download for `f` fails
+        tables['asahi-metadata'].items['a']=dict(item('a'), update_time=100)
+        fail_html.add('f')
+        poll([ item('b'), item('a'), item('f') ])
+        assert(sorted(tables['asahi-metadata'].reads) == ['a', 'b', 'f'])
+        assert(downloaded == ['b'])
+        assert(sorted(tables['asahi-content'].items.keys()) == ['b'])
+        assert(sorted(known['c'].keys()) == ['a', 'b'])
+
+        # known articles are skipped without reading the DB, the failed one is retried
+        fail_html.clear()
+        poll([ item('b'), item('a'), item('f') ])
+        assert(tables['asahi-metadata'].reads == ['f'])
+        assert(downloaded == ['f'])
+        assert(sorted(known['c'].keys()) == ['a', 'b', 'f'])
+
+        # articles no longer on the first page are forgotten
+        poll([ item('x'), item('f') ])
+        assert(sorted(known['c'].keys()) == ['f', 'x'])
+
+        # an edited article returns to the first page: its HTML is downloaded again
+        with open(os.path.join(local_paths['html'], 'c', 'a.html'), 'w') as f:
+            f.write('stale')
+
+        poll([ item('a', '300'), item('x'), item('f') ])
+        assert(tables['asahi-metadata'].reads == ['a'])
+        assert(downloaded == ['a'])
+        assert(tables['asahi-metadata'].items['a']['update_time'] == 300)
+        assert('a' in tables['asahi-content'].items)
+        assert(known['c']['a']['update_time'] == 300)
+
+        # nothing changed
+        poll([ item('a', '300'), item('x'), item('f') ])
+        assert(tables['asahi-metadata'].reads == [])
+        assert(downloaded == [])
+
+
+def test_download_metadata_resync():
+    def item(article_id, update_time='100', img_update_time='100'):
+        return {
+            'article_no': article_id,
+            'update_time': update_time,
+            'img_update_time': img_update_time,
+            'category_id': '1',
+            'movie': '',
+        }
+
+    stored={ x: dict(item(x), update_time=100) for x in ['c1', 'u1', 'u2', 'c3'] }
+    pages={
+        1: [ item('n1'), item('c1', img_update_time='200') ],
+        2: [ item('u1'), item('u2') ],
+        3: [ item('c3', update_time='300') ],
+    }
+
+    with tempfile.TemporaryDirectory() as d:
+        obj=asahi.Asahi({ 'c': 1 }, { 'json': d }, { 'metadata': 'metadata/%d/%s' })
+
+        downloaded=[]
+        def dl(url, to_file=None):
+            page=int(url.split('/')[-1])
+            downloaded.append(page)
+            with open(to_file, 'w') as f:
+                json.dump({ 'article_count': len(pages[page]), 'max_page': len(pages), 'item': pages[page] }, f)
+
+        obj._dl=dl
+        obj.fetch_metadata=lambda article_no: stored.get(article_no)
+
+        asyncio.run(obj.download_metadata('c', 0, metadata_subdir='subdir', resync=True))
+
+        # paging stops after page 2, in which nothing changed
+        assert(downloaded == [1, 2])
+
+        md=asahi.article_metadata(d, 'subdir', 'c')
+        md.load()
+        assert(sorted(md.data.keys()) == ['c1', 'n1'])
+        assert(md.changed == { 'c1': ['html', 'img'] })
+
+
+# guarded since worker processes of the process pool may import this module
+if __name__ == '__main__':
+    test_extract_article()
+
+    test_load_metadata()
+
+    test_changed_components()
+
+    test_download_metadata_resync()
+
+    test_save_metadata()
+
+    test_parse_articles_html()
 
-test_load_metadata()
+    test_store_articles_skip_unchanged()
 
+    test_watch_poll()